@@ -1,6 +1,170 @@
+from dataclasses import dataclass
+from functools import lru_cache
 import psycopg
 from psycopg import Error
+from psycopg.postgres import types as pg_types
+import os
 import re
+import sys
+
+# Patterns used to classify and rewrite queries, compiled once and reused on every call
+_LANDMARK_RE = re.compile(r'(?i)\b(SELECT|FROM|WHERE|GROUP BY|ORDER BY|LIMIT|COUNT|SUM|AVG|MIN|MAX)\b')
+_OP_RE = re.compile(r'(>=|<=|<>|!=|>|<|=)')
+_LEADING_SELECT_RE = re.compile(r'(?i)\s*SELECT\b')
+_INTO_RE = re.compile(r'(?i)\bINTO\b')
+_DISTINCT_RE = re.compile(r'(?i)DISTINCT\s+')
+_IDENTIFIER_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_.]*$')
+
+# Keywords that mean the query is already aggregated, and ones that end a WHERE clause
+_AGG_KEYWORDS = frozenset(('COUNT', 'SUM', 'AVG', 'MIN', 'MAX', 'GROUP BY'))
+_TAIL_KEYWORDS = frozenset(('GROUP BY', 'ORDER BY', 'LIMIT'))
+
+# Aggregates suggested for each numeric column
+_AGG_TEMPLATE = "COUNT({0}) as count_{0}, SUM({0}) as sum_{0}, AVG({0}) as avg_{0}".format
+
+# Number of rows fetched per batch when streaming results
+STREAM_BATCH_SIZE = 1000
+
+# Bytes of formatted rows collected before they are written to stdout
+OUTPUT_BUFFER_SIZE = 64 * 1024
+
+# Number of distinct commands whose landmarks and suggestions are kept around
+QUERY_CACHE_SIZE = 256
+
+# Each comparison operator mapped to its negation
+_FLIP_MAP = {
+    '>=': '<',
+    '<=': '>',
+    '<>': '=',
+    '!=': '=',
+    '>': '<=',
+    '<': '>=',
+    '=': '<>'
+}
+
+# Column type OIDs we consider worth aggregating
+_NUMERIC_OIDS = frozenset(
+    pg_types[name].oid
+    for name in ('int4', 'int8', 'int2', 'float4', 'float8', 'numeric', 'timestamp')
+)
+
+# Offsets of the keywords the suggesters care about, -1 when not present
+@dataclass(frozen=True, slots=True)
+class SqlLandmarks:
+    select_end: int = -1  # end of the leading SELECT keyword
+    from_start: int = -1  # start of the first FROM after it
+    where_start: int = -1  # start of the first WHERE clause's conditions
+    tail_start: int = -1  # start of the GROUP BY / ORDER BY / LIMIT ending that WHERE clause
+    has_agg: bool = False  # query already uses an aggregate function or GROUP BY
+
+# Find all landmarks in one pass over the query, shared by both suggesters
+# Cached since the same commands tend to be run again and again in a session
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _tokenize_sql(sql_command):
+    select_end = from_start = where_start = tail_start = -1
+    has_agg = False
+    
+    leading_select = _LEADING_SELECT_RE.match(sql_command)
+    if leading_select:
+        select_end = leading_select.end()
+    
+    for match in _LANDMARK_RE.finditer(sql_command):
+        keyword = match.group(1).upper()
+        
+        if keyword in _AGG_KEYWORDS:
+            has_agg = True
+        
+        if keyword == 'FROM':
+            if from_start < 0 and 0 <= select_end <= match.start():
+                from_start = match.start()
+        elif keyword == 'WHERE':
+            if where_start < 0:
+                where_start = match.end()
+        elif keyword in _TAIL_KEYWORDS:
+            if where_start >= 0 and tail_start < 0:
+                tail_start = match.start()
+    
+    if where_start >= 0 and tail_start < 0:
+        tail_start = len(sql_command)
+    
+    return SqlLandmarks(select_end, from_start, where_start, tail_start, has_agg)
+
+# Return the query without trailing semicolons if it is a single plain SELECT, else None
+# Postgres can't DECLARE a cursor over SELECT INTO or over several statements, so those run on the regular cursor
+def _streamable_select(sql_command):
+    if not _LEADING_SELECT_RE.match(sql_command) or _INTO_RE.search(sql_command):
+        return None
+    
+    query = sql_command.rstrip().rstrip(';')
+    if ';' in query:
+        return None
+    
+    return query
+
+# Suggest an aggregate version of the query for numeric columns
+# May not make sense for a lot of numeric columns, and we don't know what columns are useful, so we only really do this is the user selects a specific column.
+# numeric_columns names the query's numeric result columns, so cached suggestions follow changes to the schema
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _suggest_aggregate_query(sql_command, numeric_columns):
+    landmarks = _tokenize_sql(sql_command)
+    
+    # Only process SELECT queries
+    if landmarks.select_end < 0 or landmarks.from_start < 0:
+        return None
+    
+    select_clause = sql_command[landmarks.select_end:landmarks.from_start].strip()
+    
+    if landmarks.has_agg:
+        return None
+    
+    if select_clause == '*':
+        return None  # Can't aggregate on *
+    
+    # DISTINCT doesn't change which columns can be aggregated
+    distinct = _DISTINCT_RE.match(select_clause)
+    if distinct:
+        select_clause = select_clause[distinct.end():]
+    
+    # Split by comma and clean
+    select_columns = [col.strip() for col in select_clause.split(',')]
+    
+    # Only plain column references are worth aggregating, not expressions, function calls or aliases
+    # Postgres folds unquoted names to lower case and drops the table qualifier in the result columns
+    bare_columns = {col.rsplit('.', 1)[-1].lower() for col in select_columns if _IDENTIFIER_RE.match(col)}
+    if not bare_columns:
+        return None
+    
+    # Only suggest for the numeric columns of the query the user already ran that are bare column references
+    agg_columns = [col_name for col_name in numeric_columns if col_name in bare_columns]
+    if not agg_columns:
+        return None
+    
+    # Create aggregate suggestions only for numeric columns
+    agg_select = ", ".join(map(_AGG_TEMPLATE, agg_columns))
+    rest_of_query = sql_command[landmarks.from_start:]
+    
+    return f"SELECT {agg_select} {rest_of_query}"
+
+# Suggest query with flipped WHERE conditions
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _suggest_flipped_conditions(sql_command):
+    landmarks = _tokenize_sql(sql_command)
+    
+    # Only process queries with WHERE clause
+    if landmarks.where_start < 0:
+        return None
+    
+    where_clause = sql_command[landmarks.where_start:landmarks.tail_start].strip()
+    
+    # Splitting on the captured operators leaves them at the odd positions, so they can be flipped without a callback per match
+    parts = _OP_RE.split(where_clause)
+    parts[1::2] = map(_FLIP_MAP.__getitem__, parts[1::2])
+    flipped_where = "".join(parts)
+    
+    before_where = sql_command[:landmarks.where_start]
+    after_where = sql_command[landmarks.tail_start:]
+    
+    return f"{before_where} {flipped_where}{after_where}"
 
 class PostgreSQLManager:
     # We have 2 values to save, the connection and a cursor to manage giving commands to postgreSQL
@@ -33,102 +197,21 @@ class PostgreSQLManager:
             self.connection.close()
             print("Connection closed successfully")
     
-    # Suggest an aggregate version of the query for numeric columns
-    # May not make sense for a lot of numeric columns, and we don't know what columns are useful, so we only really do this is the user selects a specific column.
-    def suggest_aggregate_query(self, sql_command):
-        sql_upper = sql_command.upper()
-        
-        # Only process SELECT queries
-        if not sql_upper.strip().startswith('SELECT'):
-            return None
-        
-        select_match = re.search(r'SELECT\s+(.*?)\s+FROM', sql_command, re.IGNORECASE | re.DOTALL)
-        if not select_match:
-            return None
-        
-        select_clause = select_match.group(1).strip()
-        
-        if re.search(r'\b(COUNT|SUM|AVG|MIN|MAX|GROUP BY)\b', sql_command, re.IGNORECASE):
-            return None
-        
-        if select_clause == '*':
-            return None  # Can't aggregate on *
-        
-        # Split by comma and clean
-        columns = [col.strip() for col in select_clause.split(',')]
-        
-        # Execute query to retrieve column types, only suggesting if they are numeric
-        try:
-            self.cursor.execute(sql_command)
-            if not self.cursor.description:
-                return None
-            
-            column_info = []
-            for desc in self.cursor.description:
-                col_name = desc[0]
-                col_type = desc[1]
-
-                numeric_types = {23, 20, 21, 700, 701, 1700, 1114}  # common numeric type OIDs
-                if col_type in numeric_types:
-                    column_info.append(col_name)
-            
-            self.cursor.fetchall()
-            
-            if not column_info:
-                return None
-            
-            # Create aggregate suggestions only for numeric columns
-            agg_columns = []
-            for col_name in column_info:
-                agg_columns.append(f"COUNT({col_name}) as count_{col_name}, SUM({col_name}) as sum_{col_name}, AVG({col_name}) as avg_{col_name}")
-            
-            agg_select = ", ".join(agg_columns)
-            rest_of_query = sql_command[select_match.end(1):]
-            
-            return f"SELECT {agg_select}{rest_of_query}"
-            
-        except Error:
-            return None
+    # Suggest an aggregate version of the query for numeric columns, using the description execute_sql returned for it
+    def suggest_aggregate_query(self, sql_command, description):
+        numeric_columns = tuple(col.name for col in description or () if col.type_code in _NUMERIC_OIDS)
+        return _suggest_aggregate_query(sql_command, numeric_columns)
     
     # Suggest query with flipped WHERE conditions
     def suggest_flipped_conditions(self, sql_command):
-        sql_upper = sql_command.upper()
-        
-        # Only process queries with WHERE clause
-        if 'WHERE' not in sql_upper:
-            return None
-        
-        where_match = re.search(r'\bWHERE\b(.*?)(?:\bGROUP BY\b|\bORDER BY\b|\bLIMIT\b|$)', sql_command, re.IGNORECASE | re.DOTALL)
-        if not where_match:
-            return None
-        
-        where_clause = " " + where_match.group(1).strip()
-        
-        def flip_operator(match):
-            op = match.group(0)
-            flip_map = {
-                '>=': '<',
-                '<=': '>',
-                '<>': '=',
-                '!=': '=',
-                '>': '<=',
-                '<': '>=',
-                '=': '<>'
-            }
-            return flip_map.get(op, op)
-        
-        flipped_where = re.sub(r'(>=|<=|<>|!=|>|<|=)', flip_operator, where_clause)
-        
-        before_where = sql_command[:where_match.start(1)]
-        after_where = sql_command[where_match.end(1):]
-        
-        return f"{before_where}{flipped_where}{after_where}"
+        return _suggest_flipped_conditions(sql_command)
     
     # Print suggested alternative queries
-    def print_query_suggestions(self, sql_command):
+    # result_description is the column description returned by execute_sql for the same command
+    def print_query_suggestions(self, sql_command, result_description=None):
         suggestions = []
         
-        agg_query = self.suggest_aggregate_query(sql_command)
+        agg_query = self.suggest_aggregate_query(sql_command, result_description)
         if agg_query:
             suggestions.append(("Aggregate Query", agg_query, "This query might be worth running to get an average of the data you just retrieved."))
         
@@ -147,28 +230,61 @@ class PostgreSQLManager:
             print("Error: No active database connection")
             return
 
+    # Print the rows of an executed query as they are fetched, returning its column description
+    def print_results(self, cursor):
+        description = cursor.description
+        column_names = [col.name for col in description]
+        
+        # Print column names
+        print("\n" + " | ".join(column_names))
+        print("-" * (len(" | ".join(column_names))))
+        
+        # Print results, encoding rows into a byte buffer that is written straight to stdout in large chunks
+        # Text-only stdouts (IDLE, redirect_stdout to a StringIO, ...) have no buffer, so they get one write per batch instead
+        sys.stdout.flush()
+        out = getattr(sys.stdout, "buffer", None)
+        newline = os.linesep if out is not None else "\n"
+        buffer = bytearray()
+        row_count = 0
+        # Rows already fetched are still written if a later fetch fails partway through the results
+        try:
+            while rows := cursor.fetchmany(STREAM_BATCH_SIZE):
+                lines = newline.join([" | ".join(map(str, row)) for row in rows]) + newline
+                row_count += len(rows)
+                if out is None:
+                    sys.stdout.write(lines)
+                    continue
+                buffer += lines.encode(sys.stdout.encoding, sys.stdout.errors)
+                if len(buffer) >= OUTPUT_BUFFER_SIZE:
+                    out.write(buffer)
+                    buffer.clear()
+        finally:
+            if out is not None:
+                out.write(buffer)
+                out.flush()
+        print(f"\n({row_count} row(s) returned)")
+        return description
+
     # Execute SQL command and print results
+    # Returns the column description of the results so the suggesters don't have to run the query again
     def execute_sql(self, sql_command):
         if not self.connection or not self.cursor:
             print("Error: No active database connection")
             return
         
         try:
+            # A single plain SELECT goes through a server-side cursor so rows are fetched in batches instead of all at once
+            stream_query = _streamable_select(sql_command)
+            if stream_query:
+                with self.connection.cursor(name='stream') as cursor:
+                    cursor.execute(stream_query)
+                    return self.print_results(cursor)
+            
             self.cursor.execute(sql_command)
             
-            # Check if query returns results (SELECT, SHOW, etc.)
+            # Check if query returns results (SHOW, RETURNING, SELECT INTO, multiple statements, etc.)
             if self.cursor.description:
-                results = self.cursor.fetchall()
-                column_names = [desc[0] for desc in self.cursor.description]
-                
-                # Print column names
-                print("\n" + " | ".join(column_names))
-                print("-" * (len(" | ".join(column_names))))
-                
-                # Print results
-                for row in results:
-                    print(" | ".join(str(value) for value in row))
-                print(f"\n({len(results)} row(s) returned)")
+                return self.print_results(self.cursor)
             else:
                 # Command has no output
                 self.connection.commit()
@@ -203,8 +319,8 @@ def main():
                 break
             
             if command:
-                db.execute_sql(command)
-                db.print_query_suggestions(command)
+                result_description = db.execute_sql(command)
+                db.print_query_suggestions(command, result_description)
                 
         except KeyboardInterrupt:
             print("\n\nInterrupted by user")